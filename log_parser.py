@@ -4,96 +4,185 @@
 
 Developed and tested on Ubuntu 16.04, Python 3.5.2
 by Konstantin Veretennicov <kveretennicov@gmail.com>.
+
+Note: requires Python 3.7+ (for str.isascii()).
 '''
 
 import argparse
 import sys
 import os
 import logging
-from collections import namedtuple, Counter
+import concurrent.futures
+from collections import namedtuple
 import io
+import mmap
 import re
 import calendar
-import statistics # Note: requires Python 3.4
+import heapq
+import math
 import json
+try:
+    import orjson
+except ImportError:
+    # Note: orjson is optional; falling back to the slower stdlib encoder.
+    orjson = None
 
 
 logger = logging.getLogger(__name__)
 LogRecord = namedtuple(
     'LogRecord',
     ['year', 'month', 'language', 'file_name', 'status_code', 'bytes_served'])
-LogRecordParseError = namedtuple(
-    'LogRecordParseError',
-    ['file_path', 'line_number'])
 log_record_re = re.compile(
+    # Note: matching against the whole file buffer at once, so the pattern is
+    # anchored to line boundaries rather than to the start/end of the input.
+    # Note: sticking to the stdlib re module; JIT-compiled PCRE2 bindings do
+    # scan faster, but extracting groups from their match objects costs more
+    # than the scan saves.
+    # Note: every field is matched with a character class that stops at its
+    # closing delimiter rather than with lazy wildcards, so the engine scans
+    # each line left to right with almost no backtracking, even on lines that
+    # don't match.
     # Ex: 127.0.0.1 - -
-    r'^.+?' \
+    rb'(?m)^[^\[\n]+' \
     # Ex: [01/12/2017:13:44:20 +0000]
-    + r' \[\d+/(?P<month>\d+)/(?P<year>\d+).+?\]' \
+    + rb' \[\d+/(?P<month>\d+)/(?P<year>\d+)[^\]\n]*\]' \
     # Ex: "GET /Thai/some_\"file_name.flac HTTP/1.1"
     # Note: assuming filenames do not contain spaces; otherwise there is a
     # chance that some unexplored/unhandled edge case exists (though the chance
     # of a bug looks very low).
-    + r' \".+? /(?P<language>.+?)/(?P<file_name>.+?) .+\"' \
-    + r' (?P<status_code>\d+)' \
-    + r' (?P<bytes_served>\d+)$')
+    + rb' "[^ \n]+ /(?P<language>[^/\n]+)/(?P<file_name>[^ \n]+) [^"\n]+"' \
+    + rb' (?P<status_code>\d+)' \
+    + rb' (?P<bytes_served>\d+)\r?$')
+# Ex: some_\"file_name.flac
+file_name_escape_re = re.compile(r'\\([\\"])')
 
-def _gen_file_log_records(log_file_path):
-    '''Parse lines of a single log file into log records or parse errors.
+def _warn_line_parse_errors(log_file_path, first_line_number, line_count):
+    '''Report a run of consecutive unparsable lines.
     '''
-    with io.open(log_file_path, 'r', encoding='utf8') as f:
-        for line_number, line in enumerate(f):
-            m = log_record_re.match(line)
-            if not m:
-                yield LogRecordParseError(
-                    file_path=log_file_path,
-                    line_number=line_number)
-                continue
-            try:
-                year = int(m.group('year'))
-                month = int(m.group('month'))
-                status_code = int(m.group('status_code'))
-                bytes_served = int(m.group('bytes_served'))
-                language = m.group('language')
-                escaped_file_name = m.group('file_name')
-                file_name = escaped_file_name \
-                    .replace('\\"', '"').replace('\\\\', '\\')
-            except:
-                yield LogRecordParseError(
-                    file_path=log_file_path,
-                    line_number=line_number)
-                continue
-            yield LogRecord(
-                year=year,
-                month=month,
-                # Note: language names are not canonicalized;
-                # use lower() or something else if required
-                language=language,
-                # Note: assuming file names are case-sensitive
-                file_name=file_name,
-                status_code=status_code,
-                bytes_served=bytes_served)
-
-def _gen_dir_log_records(log_dir_path):
-    '''Parse lines of all log files from a directory into log records or errors.
+    for line_number in range(first_line_number, first_line_number + line_count):
+        logger.warning(
+            'line %d of "%s" cannot be parsed, skipping',
+            line_number, log_file_path)
+
+def _gen_buffer_log_record_batches(log_file_path, data, batch_size=10000):
+    '''Parse lines of a log file's contents into batches of log records.
+
+    Unparsable lines are reported and skipped.
     '''
-    for name in os.listdir(log_dir_path):
-        path = os.path.join(log_dir_path, name)
-        if not os.path.isfile(path):
-            logger.warning('"%s" is not a file, skipping', path)
-            continue
+    # Note: scanning the whole buffer with finditer() keeps the per-line loop
+    # inside the regex engine. Lines that don't match are skipped over by
+    # finditer(), so they are detected as gaps between consecutive matches;
+    # line numbers are only computed for such gaps.
+    # Note: records are handed out in lists rather than one by one, so that
+    # the cost of resuming generators is paid once per batch.
+    batch = []
+    line_number = 0
+    line_start = 0
+    for m in log_record_re.finditer(data):
+        match_start = m.start()
+        if match_start != line_start:
+            skipped_count = data[line_start:match_start].count(b'\n')
+            _warn_line_parse_errors(log_file_path, line_number, skipped_count)
+            line_number += skipped_count
+        line_start = m.end() + 1
         try:
-            yield from _gen_file_log_records(path)
+            year = int(m.group('year'))
+            month = int(m.group('month'))
+            status_code = int(m.group('status_code'))
+            bytes_served = int(m.group('bytes_served'))
+            # Note: only the string fields need decoding.
+            # Note: interning language names, since there are only a few
+            # distinct ones and each is used as a dict key once per record.
+            language = sys.intern(m.group('language').decode('utf8'))
+            escaped_file_name = m.group('file_name').decode('utf8')
+            # Note: unescaping in a single pass, so that an escaped backslash
+            # followed by a quote is not mistaken for an escaped quote.
+            # Note: re.sub() costs ~1us even when there is nothing to replace,
+            # so it is only run for the rare names containing a backslash.
+            file_name = file_name_escape_re.sub(r'\1', escaped_file_name) \
+                if '\\' in escaped_file_name else escaped_file_name
         except:
-            logger.warning('"%s" cannot be parsed, skipping', path)
+            _warn_line_parse_errors(log_file_path, line_number, 1)
+            line_number += 1
+            continue
+        # Note: passing fields positionally, in LogRecord field order; it
+        # takes half the time of keyword arguments on this per-record path.
+        batch.append(LogRecord(
+            year,
+            month,
+            # Note: language names are not canonicalized;
+            # use lower() or something else if required
+            language,
+            # Note: assuming file names are case-sensitive
+            file_name,
+            status_code,
+            bytes_served))
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+        line_number += 1
+    if batch:
+        yield batch
+    # Report trailing unparsable lines, if any.
+    if line_start < len(data):
+        skipped_count = data[line_start:].count(b'\n')
+        if data[-1:] != b'\n':
+            skipped_count += 1
+        _warn_line_parse_errors(log_file_path, line_number, skipped_count)
+
+def _gen_file_log_record_batches(log_file_path):
+    '''Parse lines of a single log file into batches of log records.
+    '''
+    # Note: memory-mapping the file lets the regex engine scan the OS page
+    # cache directly instead of a copy of the whole file. Only unparsable
+    # line runs are ever copied out of the mapping, to count their lines.
+    # Note: log files must not be written to or truncated while the report is
+    # being generated (e.g. by logrotate's copytruncate). Touching a mapped
+    # page past the new end of a truncated file kills the process with
+    # SIGBUS, which cannot be handled here; rotate logs out of the input
+    # directory, or copy them elsewhere, before running the report.
+    # Note: only failures to open, map or read the file are handled here;
+    # exceptions raised by the consumer of the batches are not thrown into
+    # this generator, so they are not mistaken for parse failures.
+    try:
+        with io.open(log_file_path, 'rb') as f:
+            # Note: empty files cannot be mapped, and have nothing to parse.
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Note: asking the kernel to start reading the whole file in
+                # the background right away rather than page by page as the
+                # scan faults it in. Not available on all platforms.
+                if hasattr(mmap, 'MADV_WILLNEED'):
+                    data.madvise(mmap.MADV_WILLNEED)
+                yield from _gen_buffer_log_record_batches(log_file_path, data)
+    except (OSError, ValueError):
+        logger.warning('"%s" cannot be parsed, skipping', log_file_path)
+
+def _gen_dir_log_file_paths(log_dir_path):
+    '''Generate paths of all log files from a directory.
+    '''
+    # Note: scandir() entries usually know their type from the directory
+    # listing itself, which saves a stat() call per file.
+    with os.scandir(log_dir_path) as entries:
+        for entry in entries:
+            if not entry.is_file():
+                logger.warning('"%s" is not a file, skipping', entry.path)
+                continue
+            yield entry.path
+
+# Note: localized month names, looked up once at import time;
+# use fixed locale or hardcode month list if English names are required
+month_names = tuple(calendar.month_name)
 
 def _format_month(month_number):
-    # Note: returns localized month name;
-    # use fixed locale or hardcode month list if English names are required
-    return calendar.month_name[month_number]
+    return month_names[month_number]
+
+def _get_stats(log_record_batches):
+    '''Collect statistics from a sequence of log record batches.
 
-def _get_stats(log_records):
-    '''Collect statistics from a sequence of log records.
+    Returns request counters keyed by (year, month, language) and non-ASCII
+    file name sets keyed by (year, month).
     '''
     # Note: expecting accumulators to be small enough even for large sets
     # of logs, so keeping everything in memory. For certain data this assumption
@@ -105,121 +194,172 @@ def _get_stats(log_records):
     # to discard accumulated month data and compute its statistics once we've
     # reached the next month. This could reduce somewhat the memory pressure.
     # The test data, however, is not ordered chronologically.
-    months = {}
-    for request in log_records:
-        month_date = (request.year, request.month)
-        is_successful_request = request.status_code // 100 == 2 # 2xx
-        month_data = months.get(month_date)
-        if month_data is None:
-            months[month_date] = month_data = {
-                'year': str(request.year),
-                'month': _format_month(request.month),
-                'languages': {},
-                'non_ascii': set(),
-                'requests': {
-                    'total': 0,
-                    'success': 0,
-                    'percent_success': None,
-                }
-            }
-        month_langs = month_data['languages']
-        lang_data = month_langs.get(request.language)
-        if lang_data is None:
-            month_langs[request.language] = lang_data = {
-                'name': request.language,
-                'mean_MB': None,
-                'stddev_MB': None,
-                'total_GB': None, # Only from 2xx
-                '_total_successful_B': 0,
-                '_total_successful': 0,
-                # Note: Counter wins over list when there are many repeated
-                # values.
-                '_bytes_served_successfully': Counter(),
-            }
-        # Collect non-ASCII names.
-        if any(ord(ch) > 127 for ch in request.file_name):
-            month_data['non_ascii'].add(request.file_name)
-        # Track request successes/failures.
-        month_requests = month_data['requests']
-        month_requests['total'] += 1
-        if is_successful_request:
-            month_requests['success'] += 1
-        # Track successful requests traffic.
-        if is_successful_request:
-            lang_data['_total_successful'] += 1
-            lang_data['_total_successful_B'] += request.bytes_served
-            lang_data['_bytes_served_successfully'][request.bytes_served] += 1
-    # Finally, list months in chronological order.
-    return [months[month_date] for month_date in sorted(months)]
-
-def _gen_filter_errors(log_records_or_errors):
-    '''Report log parse errors and filter them out of the sequence.
+    # Note: the loop below runs once per log record, so record fields are
+    # unpacked into locals and per-record dict lookups are kept to a minimum.
+    # Hot counters live in one flat list per month and language:
+    # [total, successful, successful bytes, successful bytes squared];
+    # the sum of squares is enough to compute the standard deviation later.
+    # They are shaped into the report format only once all files are counted.
+    counters = {}
+    non_ascii = {}
+    for log_records in log_record_batches:
+        for year, month, language, file_name, status_code, bytes_served \
+                in log_records:
+            counters_key = (year, month, language)
+            # Note: misses happen once per month/language, so paying for an
+            # exception there is cheaper than a get() call on every hit.
+            try:
+                month_lang_counters = counters[counters_key]
+            except KeyError:
+                counters[counters_key] = month_lang_counters = [0, 0, 0, 0]
+            # Track request successes/failures.
+            month_lang_counters[0] += 1
+            if status_code // 100 == 2: # 2xx
+                # Track successful requests traffic.
+                month_lang_counters[1] += 1
+                month_lang_counters[2] += bytes_served
+                month_lang_counters[3] += bytes_served * bytes_served
+            # Collect non-ASCII names.
+            # Note: str.isascii() requires Python 3.7
+            if not file_name.isascii():
+                month_date = (year, month)
+                try:
+                    non_ascii[month_date].add(file_name)
+                except KeyError:
+                    non_ascii[month_date] = {file_name}
+    return counters, non_ascii
+
+def _get_file_stats(log_file_path):
+    '''Collect statistics from a single log file.
+    '''
+    return _get_stats(_gen_file_log_record_batches(log_file_path))
+
+def _merge_stats(stats, other_stats):
+    '''Merge statistics collected by _get_stats() into the first ones.
     '''
-    for log_record_or_error in log_records_or_errors:
-        if isinstance(log_record_or_error, LogRecordParseError):
-            error = log_record_or_error
-            logger.warning(
-                'line %d of "%s" cannot be parsed, skipping',
-                error.line_number, error.file_path)
+    counters, non_ascii = stats
+    other_counters, other_non_ascii = other_stats
+    for counters_key, other_month_lang_counters in other_counters.items():
+        month_lang_counters = counters.get(counters_key)
+        if month_lang_counters is None:
+            counters[counters_key] = other_month_lang_counters
+            continue
+        for i, count in enumerate(other_month_lang_counters):
+            month_lang_counters[i] += count
+    for month_date, other_month_non_ascii in other_non_ascii.items():
+        month_non_ascii = non_ascii.get(month_date)
+        if month_non_ascii is None:
+            non_ascii[month_date] = other_month_non_ascii
         else:
-            assert isinstance(log_record_or_error, LogRecord)
-            record = log_record_or_error
-            yield record
+            month_non_ascii.update(other_month_non_ascii)
+
+def _get_dir_stats(log_dir_path):
+    '''Collect statistics from all log files in a directory.
+    '''
+    # Note: log files are independent of each other, so they are parsed and
+    # aggregated in parallel, at most one worker process per CPU core, and
+    # only the (small) per-file statistics are sent back to be merged.
+    # A single file is parsed in-process, which avoids the cost of starting
+    # workers and also works where processes cannot be spawned.
+    log_file_paths = list(_gen_dir_log_file_paths(log_dir_path))
+    stats = {}, {}
+    if len(log_file_paths) <= 1:
+        for log_file_path in log_file_paths:
+            _merge_stats(stats, _get_file_stats(log_file_path))
+        return stats
+    max_workers = min(len(log_file_paths), os.cpu_count() or 1)
+    with concurrent.futures.ProcessPoolExecutor(max_workers) as executor:
+        for file_stats in executor.map(_get_file_stats, log_file_paths):
+            _merge_stats(stats, file_stats)
+    return stats
 
 def _reshape_stats(stats, top_count=5):
-    '''Compute aggregates and update stats to comply with the output format.
+    '''Compute aggregates and shape stats into the output format.
     '''
+    # Note: building the report directly from the counters in a single pass
+    # over months, computing aggregates only for the reported languages.
     mb = 1000 * 1000
     gb = 1000 * 1000 * 1000
-    for month_data in stats:
-        # Fill in monthly requests' success percentage.
-        month_requests = month_data['requests']
-        assert month_requests['total'] != 0 # Should be true by construction.
-        month_requests['percent_success'] = \
-            month_requests['success'] * 100 / month_requests['total']
-        # Shape non-ASCII name set into list (json doesn't like sets).
-        month_data['non_ascii'] = list(month_data['non_ascii'])
-        # Shape language stats.
-        month_langs = month_data['languages']
-        reshaped_month_langs = sorted(
-            month_langs.values(),
-            key=lambda ml: ml['_total_successful_B'],
-            reverse=True)
-        del reshaped_month_langs[top_count:]
-        # Fill in per-language traffic statistics.
-        for lang_data in reshaped_month_langs:
-            lang_data['total_GB'] = lang_data['_total_successful_B'] / gb
-            n = lang_data['_total_successful']
+    counters, non_ascii = stats
+    # Group language counters by month, in order of first appearance.
+    months = {}
+    for (year, month, language), month_lang_counters in counters.items():
+        month_date = (year, month)
+        month_langs = months.get(month_date)
+        if month_langs is None:
+            months[month_date] = month_langs = []
+        month_langs.append((language, month_lang_counters))
+    # List months in chronological order.
+    reshaped_stats = []
+    for month_date in sorted(months):
+        year, month = month_date
+        month_langs = months[month_date]
+        # Compute monthly requests' success percentage.
+        total = sum(
+            month_lang_counters[0] for _, month_lang_counters in month_langs)
+        success = sum(
+            month_lang_counters[1] for _, month_lang_counters in month_langs)
+        assert total != 0 # Should be true by construction.
+        # Compute per-language traffic statistics for top languages.
+        reshaped_month_langs = []
+        for language, (_, n, total_B, total_B2) in heapq.nlargest(
+                top_count,
+                month_langs,
+                key=lambda lang_counters: lang_counters[1][2]):
             if n:
-                pop_mean = lang_data['_total_successful_B'] / n / mb
-                # Note: using pstdev assuming that logs are the full dataset
-                # and not a sample.
-                pop_stdev = statistics.pstdev(
-                    (bytes_served / mb
-                        for bytes_served
-                        in lang_data['_bytes_served_successfully'].elements()),
-                    mu=pop_mean)
+                pop_mean = total_B / n / mb
+                # Note: using population variance assuming that logs are
+                # the full dataset and not a sample. It is computed in bytes
+                # with exact integer arithmetic, so there is no cancellation
+                # error, and scaled to megabytes once at the end.
+                scaled_pop_variance = n * total_B2 - total_B * total_B
+                pop_stdev = math.sqrt(scaled_pop_variance) / n / mb
             else:
                 # Empty dataset -> statistics is not defined.
                 pop_mean = None
                 pop_stdev = None
-            lang_data['mean_MB'] = pop_mean
-            lang_data['stddev_MB'] = pop_stdev
-            # Remove temp keys.
-            for key in list(lang_data):
-                if key[:1] == '_':
-                    del lang_data[key]
-        month_data['languages'] = reshaped_month_langs
+            reshaped_month_langs.append({
+                'name': language,
+                'mean_MB': pop_mean,
+                'stddev_MB': pop_stdev,
+                'total_GB': total_B / gb, # Only from 2xx
+            })
+        reshaped_stats.append({
+            'year': str(year),
+            'month': _format_month(month),
+            'languages': reshaped_month_langs,
+            # Shape non-ASCII name set into list (json doesn't like sets).
+            'non_ascii': list(non_ascii.get(month_date, ())),
+            'requests': {
+                'total': total,
+                'success': success,
+                'percent_success': success * 100 / total,
+            },
+        })
+    return reshaped_stats
+
+def _dump_stats(stats, f):
+    '''Serialize stats as JSON into a binary file.
+    '''
+    if orjson is not None:
+        f.write(orjson.dumps(
+            stats, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS))
+    else:
+        # Note: not escaping non-ASCII characters, same as orjson.
+        f.write(json.dumps(
+            stats, indent=' ' * 2, sort_keys=True, ensure_ascii=False)
+            .encode('utf8'))
 
 def main(log_dir_path, report_file_path):
     try:
-        log_records = _gen_filter_errors(_gen_dir_log_records(log_dir_path))
-        stats = _get_stats(log_records)
-        _reshape_stats(stats)
-        f, release_f = (sys.stdout, lambda: None) if report_file_path == '-' \
-            else (io.open(report_file_path, 'w', encoding='utf8'), f.close)
+        stats = _reshape_stats(_get_dir_stats(log_dir_path))
+        if report_file_path == '-':
+            f, release_f = sys.stdout.buffer, sys.stdout.buffer.flush
+        else:
+            f = io.open(report_file_path, 'wb')
+            release_f = f.close
         try:
-            json.dump(stats, f, indent=' ' * 2, sort_keys=True)
+            _dump_stats(stats, f)
         finally:
             release_f()
         return 0
@@ -232,7 +372,8 @@ if __name__ == '__main__':
         description='Generate report from access logs.')
     parser.add_argument(
         'input_dir_path',
-        help='path to the directory with log files to be read')
+        help='path to the directory with log files to be read; files must'
+            ' not be written to while the report is generated')
     parser.add_argument(
         'output_file_path',
         help='path to the JSON report file to be created; use "-" for stdout')